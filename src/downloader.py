@@ -1,75 +1,91 @@
+import array
+import json
 import os
 import re
-import threading
 import pycurl
-import xml.etree.ElementTree as ET
-from xml.dom.minidom import parseString
+
+# Matches the filename at the end of a URL, compiled once instead of on every Downloader construction.
+_FILENAME_RE = re.compile(r"(?:[^/][\d\w.]+)+$", re.IGNORECASE)
+# Matches the total length in the Content-Range header of a ranged response, including the "bytes */length" form
+# sent with 416 responses when the range can't be satisfied, e.g. for an empty file.
+_CONTENT_RANGE_RE = re.compile(rb"^content-range:\s*bytes\s+(?:\d+-\d+|\*)/(\d+)", re.IGNORECASE)
+# Incomplete ranges separated by at most this many bytes are fetched with a single request when resuming.
+_MERGE_GAP = 64 * 1024
+# Received bytes are buffered per handle and written to the output file in chunks of this size.
+_WRITE_BUFFER = 1024 * 1024
+# States of a file part, stored in a bytearray indexed by part number.
+_PENDING, _COMPLETE, _INCOMPLETE = 0, 1, 2
 
 
 class Downloader:
     def __init__(self, url, parts, path, limit):
         self.url = url
         # Extract the filename from the URL.
-        self.fileName = re.search(r"(?:[^/][\d\w.]+)+$", self.url, flags=re.IGNORECASE).group(0)
+        self.fileName = _FILENAME_RE.search(self.url).group(0)
         self.fileParts = parts
-        self.parts = parts
         self.path = path
         self.limit = limit
-        # Get the size of the target file and calculate file part size.
+        # Share connections, DNS lookups and TLS sessions between the size request and all range handles so that
+        # each part doesn't pay for its own handshakes.
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_CONNECT)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        # Get the size of the target file.
         self.fileSize = round(self._getSize())
-        self.partSize = round(self.fileSize / self.parts)
-        self.threads = {}
-        self.partPosition = {}
-        self.partState = {}
-        self.lastPosition = {}
+        # Parts are numbered from 1, so positions and states are kept in preallocated arrays indexed by part number
+        # instead of dictionaries that are hashed and grown on every progress callback.
+        self.partPosition = array.array("Q", [0] * (parts + 1))
+        self.partState = bytearray(parts + 1)
+        self.lastPosition = array.array("Q", [0] * (parts + 1))
+        self.members = {}
+        self.handles = list()
         self.stop = False
         self.resume = False
-        self.flag = False
         self.progress = 0
-        # Get XML root of state.xml file, create file if it doesn't exist.
-        if not os.path.exists(f"{self.path}/{self.fileName}_state.xml"):
-            with open(f"{self.path}/{self.fileName}_state.xml", "w") as state:
-                state.write(ET.tostring(ET.Element("data"), "unicode"))
-        tree = ET.parse(f"{self.path}/{self.fileName}_state.xml")
-        self.root = tree.getroot()
-
-    # Get file size by only downloading the HEADER and then calling getinfo() for the length.
+        self.fd = None
+
+    # Get file size by requesting only the first byte and reading the total length from the Content-Range header,
+    # servers that don't allow HEAD still answer it and its connection is reused by the range handles.
     def _getSize(self):
+        fileSize = None
+
+        def header(line):
+            nonlocal fileSize
+            match = _CONTENT_RANGE_RE.match(line)
+            if match:
+                fileSize = int(match.group(1))
+
+        # Stop the transfer if the server ignored the range and started sending the whole file.
+        def write(_data):
+            if fileSize is None:
+                return 0
+
         curl = pycurl.Curl()
         curl.setopt(curl.URL, self.url)
         curl.setopt(curl.FOLLOWLOCATION, True)
-        curl.setopt(curl.NOBODY, True)
-        curl.perform()
-        fileSize = curl.getinfo(curl.CONTENT_LENGTH_DOWNLOAD)
+        curl.setopt(curl.RANGE, "0-0")
+        curl.setopt(curl.HEADERFUNCTION, header)
+        curl.setopt(curl.WRITEFUNCTION, write)
+        curl.setopt(curl.SHARE, self.share)
+        try:
+            curl.perform()
+        except pycurl.error as error:
+            if error.args[0] != pycurl.E_WRITE_ERROR:
+                raise
+
+        # Fall back to the length of the whole response if there was no Content-Range header.
+        if fileSize is None:
+            fileSize = curl.getinfo(curl.CONTENT_LENGTH_DOWNLOAD)
         curl.close()
         return fileSize
 
-    # Track individual file part download progress, return non-zero value if stop flag is set to interrupt perform(),
-    # manage state of each part.
-    def _trackProgress(self, totalDown, currentDown, _totalUp, _currentUp):
-        part = self.threads[threading.get_native_id()]
-        # Add the current byte position of each individual part to a dictionary for writing in state.xml file.
-        self.partPosition[part] = currentDown
-
-        if currentDown != 0 and currentDown == totalDown:
-            self._save(part, "complete")
-
-        if self.stop:
-            return 1
-
     # Return the total download progress in bytes
     def getProgress(self):
-        progress = 0
+        # Start from the bytes downloaded before resuming (0 if it's a new download).
+        progress = self.progress
 
-        if self.resume:
-            if not self.flag:
-                self.flag = True
-                for i in range(1, self.fileParts + 1):
-                    self.progress += int(os.stat(f"{self.path}/{self.fileName}{i}.part").st_size)
-            progress += self.progress
-
-        for position in self.partPosition.values():
-            progress += position
+        progress += sum(self.partPosition)
 
         if progress > self.fileSize:
             difference = progress - self.fileSize
@@ -77,78 +93,199 @@ class Downloader:
 
         return progress
 
-    # Calculate the part size, execute _downloadRange() in separate threads, merge file parts on download completion.
+    # Add a handle for each range to a CurlMulti and drive all of them from the calling thread, every handle writes
+    # its range directly into the preallocated output file.
     def download(self):
-        parts = self.parts
-        partStart = 0
-        partEnd = self.partSize
-        threads = list()
-
-        if not self.resume:
-            for part in range(1, parts + 1):
-                t = threading.Thread(target=self._downloadRange, args=(partStart, partEnd, part))
-                threads.append(t)
-                t.start()
-                # Increment partStart by 1 for the first range before adding it with partSize else only add the
-                # partSize and add partSize to partEnd for changing the end of range.
-                partStart += self.partSize + 1 if part == 1 else self.partSize
-                partEnd += self.partSize
-                self.lastPosition[part] = 0
-        else:
-            self.parts = 0
-            for filePart in self._getXMLData():
-                # Increment parts counter by 1 for each incomplete download so that save is called at the
-                # end, use regular expressions to extract starting and ending ranges from states.xml file.
-                self.parts += 1
-                partStart = re.search(r"^\d+", filePart.text).group(0)
-                partEnd = re.search(r"\d+$", filePart.text).group(0)
-                part = int(filePart.get("id"))
-                self.lastPosition[part] = int(partStart)
-
-                t = threading.Thread(target=self._downloadRange, args=(partStart, partEnd, part))
-                threads.append(t)
-                t.start()
-
-        # Call join() on all threads so that _mergeFiles() is only called after thread execution is completed.
-        for t in threads:
-            t.join()
-
-        # Only call _mergeFiles() if stop flag is set to false, so that it isn't called when pausing/stopping
-        # the download.
-        if not self.stop:
-            self._mergeFiles(f"{self.path}/{self.fileName}", parts)
-
-    # Download the specified range and write it to a file part, stop download if any exception is caught.
+        # Reset what a previous run on this object left behind, so that reinstate() after interrupt() starts from the
+        # state file instead of the stale flag, states and positions.
+        self.stop = False
+        self.progress = 0
+        self.partPosition = array.array("Q", [0] * (self.fileParts + 1))
+        self.partState = bytearray(self.fileParts + 1)
+        self.members.clear()
+        # Read the incomplete parts before the output file is touched, so that a missing state file raises instead of
+        # leaving a zero-filled file behind.
+        records = list(self._loadState()) if self.resume else list()
+        multi = pycurl.CurlMulti()
+        # Multiplex all range requests over a single connection when the server speaks HTTP/2.
+        multi.setopt(pycurl.M_PIPELINING, pycurl.PIPE_MULTIPLEX)
+        # Open the output file without truncating it when resuming and reserve the whole file size up front, so
+        # that each range can be written at its own offset and no merge is needed after completion, with the same
+        # permissions open() gives a new file.
+        flags = os.O_WRONLY | os.O_CREAT if self.resume else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(f"{self.path}/{self.fileName}", flags, 0o666)
+
+        # Close the file and the CurlMulti and save the state of the parts even if something fails on the way.
+        try:
+            # posix_fallocate() rejects a length of 0, an empty file has nothing to reserve.
+            if self.fileSize > 0:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(self.fd, 0, self.fileSize)
+                else:
+                    os.ftruncate(self.fd, self.fileSize)
+
+            if not self.resume:
+                for part in range(1, self.fileParts + 1):
+                    partStart, partEnd = self._partRange(part)
+                    self.lastPosition[part] = partStart
+                    # A part is empty if the file has fewer bytes than parts, there's no valid range to request.
+                    if partStart > partEnd:
+                        self._save(part, _COMPLETE)
+                        continue
+                    self._addHandle(multi, self._downloadRange(partStart, partEnd, part))
+            else:
+                # Everything except the remaining ranges of incomplete parts has already been downloaded.
+                self.progress = self.fileSize
+                ranges = list()
+                for part, partStart, partEnd in records:
+                    ranges.append((partStart, partEnd, part))
+                    self.progress -= partEnd - partStart + 1
+
+                # Coalesce ranges that are adjacent or only separated by a small gap, re-downloading the gap is
+                # cheaper than issuing another request.
+                groups = list()
+                for partStart, partEnd, part in sorted(ranges):
+                    if groups and partStart - groups[-1][-1][1] - 1 <= _MERGE_GAP:
+                        groups[-1].append((partStart, partEnd, part))
+                    else:
+                        groups.append([(partStart, partEnd, part)])
+
+                # Download each group with one handle identified by its first part, remember the parts it covers so
+                # that its progress can be split between them when it finishes.
+                for group in groups:
+                    partStart, _, part = group[0]
+                    self.members[part] = group
+                    self.lastPosition[part] = partStart
+                    self._addHandle(multi, self._downloadRange(partStart, group[-1][1], part))
+
+            # Let libcurl progress all transfers concurrently, waiting on their sockets between calls to perform()
+            # and collecting finished handles until none are left running or the stop flag is set, which is checked
+            # here instead of in a progress callback invoked by libcurl for every handle.
+            running = True
+            while running and not self.stop:
+                _, running = multi.perform()
+                self._collectHandles(multi)
+                if running and not self.stop:
+                    multi.select(1.0)
+        finally:
+            # Abort the transfers that are still running and save their parts as incomplete, a failed write of one
+            # part mustn't keep the others, the file and the state from being cleaned up and saved.
+            error = None
+            for curl in list(self.handles):
+                try:
+                    self._closeHandle(multi, curl, _INCOMPLETE)
+                except OSError as exception:
+                    error = error or exception
+
+            multi.close()
+            os.close(self.fd)
+            # Write the state of every part once, after all transfers have either finished or been interrupted.
+            self._saveState()
+
+            if error:
+                raise error
+
+    # Return the first and last byte of a part, the parts partition the file with integer arithmetic so that they're
+    # contiguous and cover every byte exactly once even if the file size isn't divisible by the number of parts.
+    def _partRange(self, part):
+        return (part - 1) * self.fileSize // self.fileParts, part * self.fileSize // self.fileParts - 1
+
+    # Create a handle that downloads the specified range into the output file once it's added to a CurlMulti.
     def _downloadRange(self, startRange, endRange, fileNo):
-        # Get uniquely assigned ID of the current thread by the kernel to identify file part.
-        self.threads[threading.get_native_id()] = fileNo
-        path = f"{self.path}/{self.fileName}{fileNo}.part"
+        offset = int(startRange)
+        buffer = bytearray()
+        # Bind everything the callbacks use to locals once, since write() is called for every chunk received.
+        fd = self.fd
+        partPosition = self.partPosition
+        extend = buffer.extend
+        pwrite = os.pwrite
+        # Count the bytes written by this handle from 0, flush() only adds to the position.
+        partPosition[fileNo] = 0
+
+        # Collect the received bytes so that many small callbacks result in a single write to the output file.
+        def write(data):
+            extend(data)
+            if len(buffer) >= _WRITE_BUFFER:
+                flush()
+
+        # Write the buffered bytes at their absolute position in the output file and advance the offset, pwrite() may
+        # write fewer bytes than requested so the rest is written until the buffer is empty. The position of the part
+        # for getProgress() and the state file only counts bytes that reached the file, and if pwrite() fails the
+        # unwritten bytes stay in the buffer.
+        def flush():
+            nonlocal offset
+            written = 0
+            try:
+                with memoryview(buffer) as view:
+                    while written < len(view):
+                        count = pwrite(fd, view[written:], offset + written)
+                        written += count
+                        partPosition[fileNo] += count
+            finally:
+                offset += written
+                del buffer[:written]
+
+        curl = pycurl.Curl()
+        curl.part = fileNo
+        curl.flush = flush
+        curl.setopt(curl.URL, self.url)
+        curl.setopt(curl.FOLLOWLOCATION, True)
+        curl.setopt(curl.RANGE, f"{startRange}-{endRange}")
+        curl.setopt(curl.SHARE, self.share)
+        # Receive up to 512 KiB per write callback instead of libcurl's 16 KiB default, and keep idle connections
+        # alive and reopen them with TCP Fast Open.
+        curl.setopt(curl.BUFFERSIZE, 512 * 1024)
+        curl.setopt(curl.TCP_FASTOPEN, True)
+        curl.setopt(curl.TCP_KEEPALIVE, True)
+        curl.setopt(curl.WRITEFUNCTION, write)
+        curl.setopt(curl.MAX_RECV_SPEED_LARGE, self.limit)
+        return curl
+
+    # Add the handle to the CurlMulti and keep track of it until it's closed.
+    def _addHandle(self, multi, curl):
+        self.handles.append(curl)
+        multi.add_handle(curl)
+
+    # Remove finished handles from the CurlMulti and close them, save the part as complete if its transfer succeeded
+    # else as incomplete.
+    def _collectHandles(self, multi):
+        while True:
+            queued, succeeded, failed = multi.info_read()
+            for curl in succeeded:
+                self._closeHandle(multi, curl, _COMPLETE)
+            for curl, _errno, _message in failed:
+                self._closeHandle(multi, curl, _INCOMPLETE)
+            if not queued:
+                break
+
+    # Save the state of a finished range, splitting the progress of a coalesced range between the parts it covers.
+    def _finishRange(self, part, state):
+        if part not in self.members:
+            self._save(part, state)
+            return
+
+        position = self.lastPosition[part] + self.partPosition[part]
+        for partStart, partEnd, member in self.members.pop(part):
+            self.lastPosition[member] = partStart
+            self.partPosition[member] = min(max(position - partStart, 0), partEnd - partStart + 1)
+            self._save(member, _COMPLETE if state == _COMPLETE or position > partEnd else _INCOMPLETE)
+
+    # Write out the remaining buffered bytes, save the state of the range, detach the handle from the CurlMulti and
+    # release it. The range is saved as incomplete if its bytes couldn't be written, and the handle is released
+    # before the error is raised.
+    def _closeHandle(self, multi, curl, state):
         try:
-            # Append bytes to file if it exists (resuming) else only write.
-            with open(path, "ab" if (os.path.exists(path)) else "wb") as f:
-                curl = pycurl.Curl()
-                curl.setopt(curl.URL, self.url)
-                curl.setopt(curl.FOLLOWLOCATION, True)
-                curl.setopt(curl.RANGE, f"{startRange}-{endRange}")
-                curl.setopt(curl.WRITEDATA, f)
-                curl.setopt(curl.NOPROGRESS, False)
-                curl.setopt(curl.MAX_RECV_SPEED_LARGE, self.limit)
-                curl.setopt(curl.XFERINFOFUNCTION, self._trackProgress)
-                curl.perform()
-                curl.close()
-        except pycurl.error:
-            self._save(fileNo, "incomplete")
-
-    # Merge the file parts into one and delete the parts.
-    def _mergeFiles(self, fileName, parts):
-        with open(fileName, "wb") as o:
-            for part in range(1, parts + 1):
-                with open(f"{self.path}/{self.fileName}{part}.part", "rb") as p:
-                    o.write(p.read())
-                os.remove(f"{self.path}/{self.fileName}{part}.part")
-            #os.remove(f"{self.path}/{self.fileName}_state.xml")
-
-    # Set stop flag to interrupt perform() execution.
+            curl.flush()
+        except OSError:
+            state = _INCOMPLETE
+            raise
+        finally:
+            self._finishRange(curl.part, state)
+            self.handles.remove(curl)
+            multi.remove_handle(curl)
+            curl.close()
+
+    # Set stop flag to abort the transfers driven by download().
     def interrupt(self):
         self.stop = True
 
@@ -157,52 +294,41 @@ class Downloader:
         self.resume = True
         self.download()
 
-    # Write part position to state.xml file.
+    # Record the state of a part, it's written to the state file by _saveState().
     def _save(self, part, state):
-        # Only decrement parts counter if that specific part's state hasn't been added to partState
-        # so that it isn't called in succession after download complete because _trackProgress()
-        # might be called several times even after completion.
-        if part not in self.partState.keys():
-            self.parts -= 1
+        # Only record the first state saved for a part while it is still pending.
+        if not self.partState[part]:
             self.partState[part] = state
 
-        if not self.parts:
-            data = self._setXMLData()
-            with open(f"{self.path}/{self.fileName}_state.xml", "w") as state:
-                state.write(parseString(ET.tostring(data, encoding="unicode")).toprettyxml())
-
-    # Fetches incomplete states for the current download from state.xml file.
-    def _getXMLData(self):
-        file = self.root.find("file")
-        for filePart in file:
-            if filePart.get("state") == "incomplete":
-                yield filePart
-
-    # Stores the state and byte position of each file part in XML inside a variable.
-    def _setXMLData(self):
-        data = ET.Element("data")
-        file = ET.SubElement(data, "file")
-        file.set("name", self.fileName)
-
-        for part in self.partPosition.keys():
-            item = ET.SubElement(file, "part")
-            item.set("id", str(part))
-            item.set("state", self.partState[part])
-            # Add the last byte position (0 if it's a new download) to the current position of the file part.
-            partStart = self.partPosition[part] + self.lastPosition[part]
-
-            # Add partSize to the starting position only if it's a new download, so that the position isn't
-            # tempered with when resuming, and adding 1 to the starting positions for forming the next range.
-            if not self.resume:
-                partStart += (self.partSize * (part - 1))
-                partStart += 1 if part != 1 else 0
+    # Fetches incomplete parts of the current download from the state file as (id, start, end) tuples, raises
+    # FileNotFoundError if there's no state to resume from (including downloads whose state is in the old
+    # {fileName}_state.xml format) instead of reporting the download as complete.
+    def _loadState(self):
+        with open(f"{self.path}/{self.fileName}_state.json") as file:
+            records = json.load(file)
+
+        # Skip parts that were interrupted after receiving their last byte, there's nothing left to download.
+        for part, partStart, partEnd, state in records:
+            if state == _INCOMPLETE and partStart <= partEnd:
+                yield part, partStart, partEnd
+
+    # Write the state and byte range of each file part to the state file as compact [id, start, end, state] records.
+    def _saveState(self):
+        # Keep the previous state file if no part was recorded, download() failed before any transfer started.
+        if not any(self.partState):
+            return
+
+        records = list()
 
-            # Decrement partStart by 1 if the download is complete to cancel out the incrementation done during
-            # the first download, so that the range doesn't go over 100%.
-            if self.partState[part] == "complete":
-                partStart -= 1
+        for part, state in enumerate(self.partState):
+            if state == _PENDING:
+                continue
 
-            partEnd = self.partSize * part
-            item.text = str(f"{partStart}-{partEnd}")
+            # Add the starting byte position of this download to the current position of the file part, so that a
+            # complete part starts right after its last byte.
+            partStart = self.lastPosition[part] + self.partPosition[part]
+            _, partEnd = self._partRange(part)
+            records.append([part, partStart, partEnd, state])
 
-        return data
+        with open(f"{self.path}/{self.fileName}_state.json", "w") as file:
+            json.dump(records, file)